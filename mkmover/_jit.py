@@ -0,0 +1,68 @@
+"""Optional compiled sampling kernels.
+
+Neither backend is a hard dependency. The Cython extension (mkmover._sampler) is
+used when it was built at install time, otherwise numba is used if installed.
+When neither is available sample_indices is None and callers fall back to NumPy,
+and walk_states runs as plain Python.
+"""
+
+import numpy as np
+
+def _bisect_right(cdf, x):
+    lo = 0
+    hi = len(cdf)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if x < cdf[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _sample_indices(cdf, total, n, rng):
+    """Draw n indices into a compiled CDF (equivalent to bisect_right) using the Generator rng"""
+    out = np.empty(n, np.int64)
+    for i in range(n):
+        out[i] = _bisect_right(cdf, rng.random() * total)
+    return out
+
+def _walk_states(cdf, totals, next_state, start, n, rng):
+    """Walk n steps of a Markov chain over state keys.
+    Row k of cdf (padded with totals[k]) is the CDF of outcomes in state k, and
+    next_state[k, j] is the key reached by outcome j, or -1 if that state is unknown.
+    Returns the keys visited, truncated before the first unknown state
+    """
+    out = np.empty(n, np.int64)
+    key = start
+    width = cdf.shape[1]
+    for step in range(n):
+        j = _bisect_right(cdf[key], rng.random() * totals[key])
+        # numba does not bounds check; treat a draw past the last column as leading nowhere
+        key = next_state[key, j] if j < width else -1
+        if key < 0:
+            return out[:step]
+        out[step] = key
+    return out
+
+try:
+    from ._sampler import sample_indices, walk_states
+except ImportError:
+    # numba is only imported when the Cython kernels are unavailable, as it is slow to import
+    try:
+        from numba import njit
+    except ImportError:
+        sample_indices = None
+        walk_states = _walk_states
+    else:
+        _bisect_right = njit(cache=True)(_bisect_right)
+        sample_indices = njit(cache=True, fastmath=True)(_sample_indices)
+        walk_states = njit(cache=True)(_walk_states)
+
+def warmup():
+    """Call each kernel once on tiny inputs so numba compiles (or loads from its cache)
+    ahead of the first timed call. Not run on import, to keep import cheap
+    """
+    rng = np.random.default_rng()
+    if sample_indices is not None:
+        sample_indices(np.ones(1), 1.0, 1, rng)
+    walk_states(np.ones((1, 1)), np.ones(1), np.zeros((1, 1), np.int64), 0, 1, rng)
@@ -0,0 +1,55 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled sampling kernels. Built optionally by setup.py when Cython is available."""
+
+import numpy as np
+
+from cpython.pycapsule cimport PyCapsule_GetPointer
+from numpy.random cimport bitgen_t
+
+cdef inline Py_ssize_t _bisect_right(const double[::1] cdf, double x) noexcept nogil:
+    cdef Py_ssize_t lo = 0
+    cdef Py_ssize_t hi = cdf.shape[0]
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if x < cdf[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def sample_indices(const double[::1] cdf, double total, Py_ssize_t n, rng):
+    """Draw n indices into a compiled CDF (equivalent to bisect_right) using the Generator rng"""
+    bit_generator = rng.bit_generator
+    cdef bitgen_t *bitgen = <bitgen_t *> PyCapsule_GetPointer(bit_generator.capsule, "BitGenerator")
+    out = np.empty(n, dtype=np.int64)
+    cdef long long[::1] out_view = out
+    cdef Py_ssize_t i
+    with bit_generator.lock, nogil:
+        for i in range(n):
+            out_view[i] = _bisect_right(cdf, bitgen.next_double(bitgen.state) * total)
+    return out
+
+def walk_states(const double[:, ::1] cdf, const double[::1] totals, const long long[:, ::1] next_state,
+                Py_ssize_t start, Py_ssize_t n, rng):
+    """Walk n steps of a Markov chain over state keys; see mkmover._jit._walk_states.
+    Each step's draw, search and state rotation run in one nogil loop
+    """
+    bit_generator = rng.bit_generator
+    cdef bitgen_t *bitgen = <bitgen_t *> PyCapsule_GetPointer(bit_generator.capsule, "BitGenerator")
+    out = np.empty(n, dtype=np.int64)
+    cdef long long[::1] out_view = out
+    cdef Py_ssize_t width = cdf.shape[1]
+    cdef Py_ssize_t key = start
+    cdef Py_ssize_t step = 0
+    cdef Py_ssize_t j
+    with bit_generator.lock, nogil:
+        while step < n:
+            j = _bisect_right(cdf[key], bitgen.next_double(bitgen.state) * totals[key])
+            # bounds checks are off; treat a draw past the last column as leading nowhere
+            key = next_state[key, j] if j < width else -1
+            if key < 0:
+                break
+            out_view[step] = key
+            step += 1
+    return out[:step]
@@ -1,46 +1,77 @@
 __all__ = ['Agent', 'MemoryAgent', 'Location', 'AgentMover', 'EventType', 'Event', 'ModelState', 'Model']
 
+import copy
 import dataclasses
 import enum
-import math
 import heapq
+import multiprocessing
+import random
+import sys
 from collections import deque, defaultdict
 from functools import total_ordering
+from operator import attrgetter
 from typing import Hashable
 from abc import ABC, abstractmethod
 
+def intern_name(name: Hashable):
+    """Intern string identifiers so that equal names share a single object.
+    Equality checks (e.g. in dict lookups on state tuples) then short-circuit on identity
+    """
+    if isinstance(name, str):
+        return sys.intern(name)
+    return name
+
 class HeapList():
-    """Class that is used to maintain a sorted list"""
-    def __init__(self, data=None):
+    """Class that is used to maintain a sorted list, backed by a binary heap.
+    Entries are stored as (key, insertion count, item), so the heap compares plain tuples
+    and breaks ties first-in first-out without comparing the items themselves
+    """
+    def __init__(self, data=None, key=None):
+        self.key = key
+        self._count = 0 # plain int rather than itertools.count, which cannot be copied or pickled from 3.14
         if data is None:
             self.heap = []
         else:
-            self.heap = list(data)
+            self.heap = [self._entry(item) for item in data]
             heapq.heapify(self.heap)
 
+    def _entry(self, item):
+        self._count += 1
+        if self.key is None:
+            return (item, self._count, item)
+        return (self.key(item), self._count, item)
+
     def add(self, item):
         """Push item onto heap"""
-        heapq.heappush(self.heap, item)
+        heapq.heappush(self.heap, self._entry(item))
 
     def __getitem__(self, index):
-        return self.heap[index]
+        return self.heap[index][-1]
 
     def pop(self):
         """Pop the minimum item (first item)"""
-        return heapq.heappop(self.heap)
+        return heapq.heappop(self.heap)[-1]
+
+    def clear(self):
+        """Remove all items"""
+        self.heap.clear()
 
     def __len__(self):
         return len(self.heap)
 
 class Agent():
+    __slots__ = ('id', '_infected', 'location', '_loc_obj', '_state_cache')
+
     def __init__(self, name: Hashable):
         """Represents a patient or other vector.
 
         :param name: unique identifier
         """
         self.id = name
-        self.infected = False
+        self._infected = False
         self.location = None
+        self._loc_obj = None # Location the agent is registered in, set by ModelState.move
+        self._state_cache = None
 
     def __repr__(self):
         return f"{self.__class__}(name={self.id})" 
@@ -53,11 +84,21 @@ class Agent():
         """
         self.location = location
 
+    @property
+    def infected(self):
+        return self._infected
+
+    @infected.setter
+    def infected(self, value):
+        self._infected = value
+        self._state_cache = None
+
     @property
     def state(self):
         return self.infected
 
 class MemoryAgent(Agent):
+    __slots__ = ('_history',)
 
     def __init__(self, name: Hashable, maxhist: int|None=None):
         """Represents a patient ot other vector. Retains a history of previously visited locations.
@@ -66,26 +107,52 @@ class MemoryAgent(Agent):
         :param maxhist: (max) length of recorded location history, defaults to None (no limit)
         """
         super().__init__(name)
-        self.history = deque(maxlen=maxhist)
+        self._history = deque(maxlen=maxhist)
 
     def __repr__(self):
-        return f"{self.__class__}(name={self.id}, maxhist={self.history.maxlen})"
+        return f"{self.__class__}(name={self.id}, maxhist={self._history.maxlen})"
+
+    @property
+    def history(self):
+        """Recorded locations, oldest first.
+        Modify it through move_to, clear_history or assignment so the cached state stays current
+        """
+        return self._history
+
+    @history.setter
+    def history(self, locations):
+        self._history = deque(locations, maxlen=self._history.maxlen)
+        self._state_cache = None
+
+    def clear_history(self):
+        """Forget all previously visited locations"""
+        self._history.clear()
+        self._state_cache = None
 
     def move_to(self, location: Hashable):
         """Record a movement to another location.
         Also inserts the new location into history for lookups
         """
         self.location = location
-        self.history.append(location)
+        self._history.append(location)
+        self._state_cache = None
 
     @property
     def state(self):
-        return self.infected, *reversed(self.history)
+        """Tuple of (infected, most recent location, ..., oldest location).
+        Cached until the next move or change in infection status
+        """
+        if self._state_cache is None:
+            self._state_cache = (self.infected, *reversed(self._history))
+        return self._state_cache
 
 class Location():
+    __slots__ = ('id', 'occupants', '_pos')
+
     def __init__(self, name: Hashable):
-        self.id = name
-        self.occupants = set()
+        self.id = intern_name(name)
+        self.occupants = [] # list of occupant names, unordered
+        self._pos = dict() # map of occupant name to index in occupants
 
     def __repr__(self):
         return f"Location('{self.id}')"
@@ -93,6 +160,32 @@ class Location():
     def __str__(self) -> str:
         return F"Location ({self.id}) [{len(self.occupants)}]"
 
+    def __contains__(self, agent: Hashable):
+        return agent in self._pos
+
+    def add(self, agent: Hashable):
+        """Add an occupant. No-op if already present"""
+        if agent in self._pos:
+            return
+        self._pos[agent] = len(self.occupants)
+        self.occupants.append(agent)
+
+    def discard(self, agent: Hashable):
+        """Remove an occupant if present.
+        Swaps the last occupant into the vacated slot so removal is O(1)
+        """
+        i = self._pos.pop(agent, None)
+        if i is None:
+            return
+        last = self.occupants.pop()
+        if i < len(self.occupants):
+            self.occupants[i] = last
+            self._pos[last] = i
+
+    def sample_occupants(self, k: int):
+        """Sample k distinct occupants uniformly at random"""
+        return random.sample(self.occupants, k)
+
 class AgentMover(ABC):
     """Helper object that can be used to determine the next location an agent moves to
     
@@ -103,13 +196,19 @@ class AgentMover(ABC):
         """Returns the next location that an agent would move to"""
         pass
 
+    def next_locations(self, state: Hashable, n: int):
+        """Returns n independent next locations for agents in the given state.
+        Implementations should override this with a batched draw where possible
+        """
+        return [self.next_location(state) for _ in range(n)]
+
 # EventType = enum.Enum('EventType', [])
 @total_ordering
 class EventType(enum.Enum):
     def __lt__(self, other):
         return self.value < other.value
 
-@dataclasses.dataclass(frozen=True, eq=True, order=True)
+@dataclasses.dataclass(frozen=True, eq=True, order=True, slots=True)
 class Event():
     """Data object that represents an event that will happen"""
     t: float
@@ -125,7 +224,7 @@ class ModelState():
     agents : map of agent name to Agent object
     locations: map of location name to Location object
     t: current simulation time
-    event_queue: queue (sorted list/deque) of events
+    event_queue: queue (binary heap) of events
     event_map: map of agent name to list of associated queued events
     """
     
@@ -133,7 +232,7 @@ class ModelState():
         self.agents = dict() # map of agent name to Agent
         self.locations = dict() # map of location name to Location
         self.t = 0
-        self.event_queue = HeapList() # list of events
+        self.event_queue = HeapList(key=attrgetter('t', 'event_type')) # list of events
         self.event_map = defaultdict(set) # map of agent to events
 
         self._event_base = Event
@@ -145,14 +244,17 @@ class ModelState():
         return f"ABM: [{self.t}] {len(self.agents)} agents, {len(self.locations)} locations, {len(self.event_queue)} events queued."
 
     def move(self, agent: Hashable, location: Hashable):
-        agent_obj = self.agents[agent]
-        loc_obj = self.locations[location]
-
-        old_loc = self.locations.get(agent_obj.location, None)
-        if old_loc:
-            old_loc.occupants.discard(agent)
-        agent_obj.move_to(location)
-        loc_obj.occupants.add(agent)
+        self._move_direct(self.agents[agent], self.locations[location])
+
+    def _move_direct(self, agent_obj: Agent, loc_obj: Location):
+        """Move an already resolved agent into an already resolved location"""
+        old_loc = agent_obj._loc_obj
+        if old_loc is not None:
+            old_loc.discard(agent_obj.id)
+        # hand the agent the canonical (interned) id rather than the caller's copy
+        agent_obj.move_to(loc_obj.id)
+        agent_obj._loc_obj = loc_obj
+        loc_obj.add(agent_obj.id)
 
     def add_agent(self, agent: Agent):
         self.agents[agent.id] = agent
@@ -162,14 +264,33 @@ class ModelState():
 
     def add_generic_agents(self, n: int):
         """Helper utility for adding in random agents"""
-        digits = int(math.ceil(math.log10(n)))
+        width = len(str(n - 1))
         for i in range(n):
-            agent = Agent(f"agent_{i:0{digits}}")
+            agent = Agent("agent_" + str(i).zfill(width))
             self.add_agent(agent)
 
     def move_all_to(self, location: Hashable):
-        for agent in self.agents:
-            self.move(agent, location)
+        loc_obj = self.locations[location]
+        for agent_obj in self.agents.values():
+            self._move_direct(agent_obj, loc_obj)
+
+    def step_all(self, mover: AgentMover):
+        """Move every agent to a next location drawn from mover.
+        Agents are grouped by state so each group is drawn in one batch.
+        All draws are conditioned on the states before any agent moves.
+        """
+        buckets = defaultdict(list)
+        for agent in self.agents.values():
+            buckets[agent.state].append(agent)
+        # draw and resolve every bucket before moving anyone, so a failed draw leaves the model unchanged
+        locations = self.locations
+        draws = [
+            (agents, [locations[location] for location in mover.next_locations(state, len(agents))])
+            for state, agents in buckets.items()
+        ]
+        for agents, loc_objs in draws:
+            for agent, loc_obj in zip(agents, loc_objs):
+                self._move_direct(agent, loc_obj)
 
     def add_event(self, t: float, event_type: EventType, agent: Hashable, *args, **kwargs):
         event = self._event_base(t, event_type, agent, *args, **kwargs)
@@ -179,6 +300,20 @@ class ModelState():
 class ModelHistory(list):
     pass
 
+_template_model = None # model copied by each run in a run_many worker process
+
+def _set_template_model(model):
+    global _template_model
+    _template_model = model
+
+def _run_seeded(seed, until):
+    from .markov_mover import seed as seed_batch
+    random.seed(seed)
+    seed_batch(seed)
+    model = copy.deepcopy(_template_model)
+    model.simulate(until)
+    return model.history
+
 class Model(ABC):
 
     def __init__(self):
@@ -187,4 +322,22 @@ class Model(ABC):
 
     @abstractmethod
     def simulate(self, until=None):
-        pass
\ No newline at end of file
+        pass
+
+    def run_many(self, seeds, until=None, processes: int|None=None):
+        """Run independent copies of this model in a pool of worker processes.
+        Each run starts from a copy of the current model and seeds the random
+        module and the batched-draw generator with its seed.
+
+        :param seeds: one seed per run
+        :param until: passed through to simulate
+        :param processes: number of worker processes, defaults to the number of CPUs
+        :return: list of the history of each run, in the order of seeds
+        """
+        # with fork the model is inherited by the workers instead of pickled
+        if 'fork' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing.get_context()
+        with ctx.Pool(processes, initializer=_set_template_model, initargs=(self,)) as pool:
+            return pool.starmap(_run_seeded, [(seed, until) for seed in seeds])
\ No newline at end of file
@@ -1,26 +1,141 @@
 import random
 from bisect import bisect
 from collections import ChainMap
+from itertools import accumulate
 from typing import Hashable
-from .abm import AgentMover
+
+import numpy as np
+
+from .abm import AgentMover, intern_name
+from ._jit import sample_indices, walk_states
+
+# shared generator for batched draws; single draws use the random module
+_rng = np.random.default_rng()
+
+_TABLE_BITS = 8
+_TABLE_SIZE = 1 << _TABLE_BITS
+_STRADDLE = _TABLE_SIZE - 1 # table entry for buckets that contain an outcome boundary
+
+# outcome count from which batched draws use an alias table instead of bisecting the CDF
+_ALIAS_MIN = 8
+
+def seed(seed=None):
+    """Reseed the generator used for batched draws"""
+    global _rng
+    _rng = np.random.default_rng(seed)
 
 class CompiledOutcomes():
+    __slots__ = ('outcomes', 'cdf', 'total', 'outcomes_arr', 'cdf_arr', '_table',
+                 '_alias_prob', '_alias', '_alias_prob_arr', '_alias_arr', 'weighted_choice')
+
     def __init__(self, data=None):
-        self.outcomes = []
-        self.cdf = []
+        self.outcomes = ()
+        self.cdf = ()
         self.total = 0
+        self.outcomes_arr = np.empty(0, dtype=object)
+        self.cdf_arr = np.empty(0)
+        self._table = b''
+        self._alias_prob = self._alias = () # alias table, built for large outcome sets
+        self._alias_prob_arr = self._alias_arr = None
+        self.weighted_choice = self._choice_n
 
         if data is not None:
             self.compile(data)
     
     def compile(self, pdict):
         """Construct the CDF for the outcome map"""
-        for k,v in pdict.items():
-            self.outcomes.append(k)
-            self.total += v
-            self.cdf.append(self.total)
+        if pdict:
+            cdf = list(accumulate(pdict.values(), initial=self.total))
+            self.outcomes += tuple([intern_name(k) for k in pdict])
+            # keep the scalar CDF as boxed floats: bisect and indexing on array.array
+            # or ndarray allocate a float per probe; cdf_arr holds the unboxed copy
+            self.cdf += tuple(cdf[1:])
+            self.total = cdf[-1]
+        self.outcomes_arr = np.fromiter(self.outcomes, dtype=object, count=len(self.outcomes))
+        self.cdf_arr = np.asarray(self.cdf, dtype=np.float64)
+        # specialise the sampler to skip the bisect call where possible
+        n = len(self.outcomes)
+        if n >= _ALIAS_MIN and self.total > 0:
+            self._compile_alias()
+        if not self.total > 0:
+            self.weighted_choice = self._choice_none
+        elif n == 1:
+            self.weighted_choice = self._choice_1
+        elif 1 < n < _STRADDLE:
+            self._compile_table()
+            self.weighted_choice = self._choice_table
+        elif self._alias:
+            self.weighted_choice = self._choice_alias
+        else:
+            self.weighted_choice = self._choice_n
+
+    def _compile_table(self):
+        """Split [0, total) into equal-width buckets and record the outcome that covers each bucket,
+        or _STRADDLE if an outcome boundary falls inside it
+        """
+        cdf = self.cdf
+        n = len(cdf)
+        table = bytearray(_TABLE_SIZE)
+        for b in range(_TABLE_SIZE):
+            i = bisect(cdf, b * self.total / _TABLE_SIZE)
+            if i < n and cdf[i] >= (b + 1) * self.total / _TABLE_SIZE:
+                table[b] = i
+            else:
+                table[b] = _STRADDLE
+        self._table = bytes(table)
+
+    def _compile_alias(self):
+        """Build Vose's alias table: outcome i is kept with probability _alias_prob[i],
+        otherwise replaced by _alias[i]
+        """
+        n = len(self.outcomes)
+        scaled = (np.diff(self.cdf_arr, prepend=0.0) * (n / self.total)).tolist()
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(large.pop())
+        # anything left over is within rounding of 1 and keeps its own outcome
+        self._alias_prob = tuple(prob)
+        self._alias = tuple(alias)
+        self._alias_prob_arr = np.asarray(prob)
+        self._alias_arr = np.asarray(alias, dtype=np.int64)
+
+    def _choice_none(self):
+        raise ValueError("cannot draw from outcomes whose weights sum to zero")
+
+    def _choice_1(self):
+        return self.outcomes[0]
+
+    def _choice_table(self):
+        """O(1) lookup of a uniformly drawn bucket.
+        Only buckets straddling an outcome boundary (at most n-1 of them) draw a position
+        within the bucket and bisect, so the result is exact
+        """
+        b = random.getrandbits(_TABLE_BITS)
+        i = self._table[b]
+        if i == _STRADDLE:
+            i = bisect(self.cdf, (b + random.random()) * self.total / _TABLE_SIZE)
+            if i == len(self.cdf): # (b + random()) can round up to the top of the last bucket
+                i -= 1
+        return self.outcomes[i]
+
+    def _choice_alias(self):
+        """O(1) draw from the alias table, splitting one uniform into a column and a coin"""
+        u = random.random() * len(self._alias)
+        i = int(u)
+        if u - i >= self._alias_prob[i]:
+            i = self._alias[i]
+        return self.outcomes[i]
 
-    def weighted_choice(self):
+    def _choice_n(self):
         """Provided by Raymond Hettinger on stackoverflow
         O(log(n)) lookup on a compiled CDF object
         """
@@ -28,11 +143,45 @@ class CompiledOutcomes():
         i = bisect(self.cdf, x)
         return self.outcomes[i]
 
+    def _sample_indices(self, n: int):
+        if not self.total > 0:
+            self._choice_none() # raises
+        if self._alias_arr is not None:
+            # bisecting a long CDF mispredicts branches at every level; the alias draw does not
+            i = _rng.integers(len(self._alias_arr), size=n)
+            keep = _rng.random(n) < self._alias_prob_arr[i]
+            return np.where(keep, i, self._alias_arr[i])
+        if sample_indices is not None:
+            return sample_indices(self.cdf_arr, self.total, n, _rng)
+        x = _rng.random(n) * self.total
+        return np.searchsorted(self.cdf_arr, x, side='right')
+
+    def weighted_choice_batch(self, n: int):
+        """Draw n outcomes in one vectorised call on the compiled CDF
+        Returns an object array of outcomes
+        """
+        return self.outcomes_arr[self._sample_indices(n)]
+
+    def weighted_choice_counts(self, n: int):
+        """Draw n outcomes and tally them by outcome index, without materialising the outcomes
+        Returns a map of outcome to count
+        """
+        counts = np.bincount(self._sample_indices(n), minlength=len(self.outcomes))
+        return dict(zip(self.outcomes, counts.tolist()))
+
 class MarkovMover(AgentMover):
     """Mapping of movement probabilities of an agent"""
 
     def __init__(self, *data):
         self.move_probs = ChainMap()
+        self._flat = dict() # flattened view of move_probs for lookups
+        self._state_keys = dict() # map of state to dense integer key
+        self._by_key = [] # list of CompiledOutcomes, indexed by state key
+        # last looked-up state and its outcomes; agent states are cached tuples,
+        # so repeat draws for an unchanged agent pass the identical object
+        self._last_state = None
+        self._last_outcomes = None
+        self._chain_tables = dict() # map of maxhist to packed tables for walk
         for datum in data:
             self.add_move_probs(datum)
 
@@ -42,13 +191,133 @@ class MarkovMover(AgentMover):
     def add_move_probs(self, new_map):
         """Add a new map onto the front of the chain of lookups of move probs"""
         compiled_map = {
-            key: CompiledOutcomes(value)
+            self._intern_state(key): CompiledOutcomes(value)
             for key, value in new_map.items()
         }
         self.move_probs = self.move_probs.new_child(compiled_map)
+        self._flat.update(compiled_map)
+        self._last_state = self._last_outcomes = None
+        self._chain_tables.clear()
+        for state, outcomes in compiled_map.items():
+            key = self._state_keys.setdefault(state, len(self._by_key))
+            if key == len(self._by_key):
+                self._by_key.append(outcomes)
+            else:
+                self._by_key[key] = outcomes
+
+    @staticmethod
+    def _intern_state(state: Hashable):
+        """Intern the names in a state so lookups compare by identity"""
+        if isinstance(state, tuple):
+            return tuple(intern_name(x) for x in state)
+        return intern_name(state)
 
     def next_location(self, state: Hashable):
         """Generate a realisation of the next location an agent in the given state moves to
         """
-        movement_outcomes = self.move_probs[state]
-        return movement_outcomes.weighted_choice()
\ No newline at end of file
+        if state is not self._last_state:
+            self._last_outcomes = self._flat[state]
+            self._last_state = state
+        return self._last_outcomes.weighted_choice()
+
+    def next_locations(self, state: Hashable, n: int):
+        """Generate n independent realisations of the next location for the given state
+        """
+        movement_outcomes = self._flat[state]
+        return movement_outcomes.weighted_choice_batch(n)
+
+    def next_location_counts(self, state: Hashable, n: int):
+        """Tally n independent realisations of the next location for the given state
+        Returns a map of location to count
+        """
+        return self._flat[state].weighted_choice_counts(n)
+
+    def state_key(self, state: Hashable) -> int:
+        """Dense integer key for a state, stable across later calls to add_move_probs.
+        Resolve once and reuse with the *_by_key methods to skip hashing the state on each draw
+        """
+        return self._state_keys[state]
+
+    def next_location_by_key(self, key: int):
+        """As next_location, for a state resolved with state_key"""
+        return self._by_key[key].weighted_choice()
+
+    def next_locations_by_key(self, key: int, n: int):
+        """As next_locations, for a state resolved with state_key"""
+        return self._by_key[key].weighted_choice_batch(n)
+
+    def _compile_chain(self, maxhist: int):
+        """Pack the compiled states into arrays for walk: CDF rows padded with the row total,
+        row totals, the key reached by each outcome (-1 if not compiled) and the location of each state.
+        States whose weights sum to zero get a row that only leads to -1, so walks stop on them
+        """
+        n = len(self._by_key)
+        width = max((len(outcomes.cdf) for outcomes in self._by_key), default=0)
+        cdf = np.empty((n, width))
+        totals = np.empty(n)
+        next_state = np.full((n, width), -1, dtype=np.int64)
+        locations = np.full(n, None, dtype=object)
+        for state, key in self._state_keys.items():
+            outcomes = self._by_key[key]
+            if isinstance(state, tuple) and len(state) > 1:
+                locations[key] = state[1]
+            if outcomes.total <= 0:
+                # nothing can be drawn: every draw lands in column 0, which leads to no state, so walks stop here
+                cdf[key] = 1.0
+                totals[key] = 1.0
+                continue
+            k = len(outcomes.cdf)
+            cdf[key, :k] = outcomes.cdf_arr
+            cdf[key, k:] = outcomes.total
+            totals[key] = outcomes.total
+            if not isinstance(state, tuple):
+                continue
+            for j, location in enumerate(outcomes.outcomes):
+                next_state[key, j] = self._state_keys.get((state[0], location, *state[1:maxhist]), -1)
+        return cdf, totals, next_state, locations
+
+    def walk(self, state: tuple, n: int, maxhist: int):
+        """Simulate n consecutive moves of a MemoryAgent with history length maxhist (>= 1).
+        Each move draws from the current state, then shifts the drawn location onto the front
+        of the history, as MemoryAgent.move_to does. Runs as a compiled loop when numba is available.
+
+        :return: object array of the n locations visited
+        :raises KeyError: if the walk reaches a state with no move probabilities
+        :raises ValueError: if the walk reaches a state whose move probabilities sum to zero
+        """
+        start = self._state_keys[state]
+        if maxhist not in self._chain_tables:
+            self._chain_tables[maxhist] = self._compile_chain(maxhist)
+        cdf, totals, next_state, locations = self._chain_tables[maxhist]
+        keys = walk_states(cdf, totals, next_state, start, n, _rng)
+        if len(keys) < n:
+            if not self._by_key[keys[-1] if len(keys) else start].total > 0:
+                raise ValueError(f"walk reached a state whose move probabilities sum to zero after {len(keys)} moves")
+            raise KeyError(f"walk reached a state with no move probabilities after {len(keys)} moves")
+        return locations[keys]
+
+    def stationary_distribution(self, maxhist: int):
+        """Long-run fraction of time spent at each location by a MemoryAgent with history length maxhist,
+        solved exactly from the chain that walk simulates.
+        The chain over compiled states must be closed and have a unique stationary distribution.
+
+        :return: map of location to stationary probability
+        """
+        if maxhist not in self._chain_tables:
+            self._chain_tables[maxhist] = self._compile_chain(maxhist)
+        cdf, totals, next_state, locations = self._chain_tables[maxhist]
+        n = len(totals)
+        probs = np.diff(cdf, prepend=0.0, axis=1) / totals[:, None]
+        rows, cols = np.nonzero((next_state >= 0) & (probs > 0))
+        transition = np.zeros((n, n))
+        np.add.at(transition, (rows, next_state[rows, cols]), probs[rows, cols])
+        # solve pi (P - I) = 0 subject to sum(pi) = 1
+        system = np.vstack([transition.T - np.eye(n), np.ones(n)])
+        target = np.zeros(n + 1)
+        target[-1] = 1.0
+        pi = np.linalg.lstsq(system, target, rcond=None)[0]
+        distribution = dict()
+        for key, location in enumerate(locations):
+            if location is not None:
+                distribution[location] = distribution.get(location, 0.0) + float(pi[key])
+        return distribution
@@ -1,2 +1,19 @@
 import setuptools
-setuptools.setup()
\ No newline at end of file
+
+try:
+    import numpy
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    # the compiled sampler is optional; mkmover falls back to numba/NumPy without it
+    ext_modules = cythonize([
+        setuptools.Extension(
+            "mkmover._sampler",
+            ["mkmover/_sampler.pyx"],
+            include_dirs=[numpy.get_include()],
+            optional=True,
+        ),
+    ])
+
+setuptools.setup(ext_modules=ext_modules)
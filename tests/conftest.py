@@ -0,0 +1,16 @@
+import random
+
+import pytest
+
+from mkmover import markov_mover
+
+SEED = 0xC0FFEE
+
+@pytest.fixture
+def seeded():
+    # fix both generators so statistical tests draw the same samples on every run
+    random.seed(SEED)
+    markov_mover.seed(SEED)
+    yield
+    random.seed()
+    markov_mover.seed()
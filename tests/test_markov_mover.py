@@ -0,0 +1,185 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from mkmover import markov_mover
+from mkmover.markov_mover import CompiledOutcomes, MarkovMover
+
+@pytest.fixture
+def move_probs():
+    return {
+        ('S', 'A'): {'B': 0.7, 'C': 0.3},
+        ('S', 'B'): {'A': 0.4, 'C': 0.6},
+        ('S', 'C'): {'A': 0.8, 'B': 0.2},
+    }
+
+@pytest.fixture
+def mover(move_probs):
+    return MarkovMover(move_probs)
+
+@pytest.mark.usefixtures("seeded")
+def test_weighted_choice_batch(move_probs):
+    """Tests that batch draws follow the compiled distribution"""
+
+    outcomes = CompiledOutcomes(move_probs['S', 'A'])
+    counts = Counter(outcomes.weighted_choice_batch(100_000))
+
+    assert set(counts) == {'B', 'C'}
+    assert counts['B'] / counts['C'] == pytest.approx(0.7 / 0.3, rel=1e-2)
+
+def test_weighted_choice_batch_tuple_outcomes():
+    """Tests that hashable (tuple) outcomes are returned intact from a batch"""
+
+    outcomes = CompiledOutcomes({('A', 1): 0.5, ('B', 2): 0.5})
+    draws = outcomes.weighted_choice_batch(10)
+
+    assert len(draws) == 10
+    assert set(draws) <= {('A', 1), ('B', 2)}
+
+@pytest.mark.usefixtures("seeded")
+def test_next_locations(mover, move_probs):
+    """Tests that the mover's batch lookup matches the single-draw lookup"""
+
+    counts = Counter(mover.next_locations(('S', 'C'), 100_000))
+    expected = move_probs['S', 'C']['A'] / move_probs['S', 'C']['B']
+
+    assert counts['A'] / counts['B'] == pytest.approx(expected, rel=2e-2)
+
+def test_add_move_probs_overrides(mover):
+    """Tests that newer move prob maps take precedence over older ones"""
+
+    state = ('S', 'A')
+    assert mover.next_location(state) in {'B', 'C'}
+    mover.add_move_probs({state: {'B': 1.0}})
+    assert mover.next_location(state) == 'B'
+
+    mover.add_move_probs({('S', 'A'): {'C': 1.0}})
+
+    assert mover.next_location(('S', 'A')) == 'C'
+    assert mover.next_location(('S', 'B')) in {'A', 'C'}
+
+@pytest.mark.usefixtures("seeded")
+@pytest.mark.parametrize('pdict', [
+    {'A': 1.0},
+    {'A': 0.7, 'B': 0.3},
+    {'A': 0.5, 'B': 0.3, 'C': 0.2},
+    {'A': 0.4, 'B': 0.3, 'C': 0.2, 'D': 0.1},
+    {'A': 0.001, 'B': 0.002, 'C': 0.997},
+    {i: 1 / 300 for i in range(300)},
+])
+def test_weighted_choice(pdict):
+    """Tests that each specialised single-draw sampler follows the distribution"""
+
+    outcomes = CompiledOutcomes(pdict)
+    N = 100_000
+    counts = Counter(outcomes.weighted_choice() for _ in range(N))
+
+    assert [counts[k] / N for k in pdict] == pytest.approx(list(pdict.values()), abs=1e-2)
+
+def test_state_key(mover):
+    """Tests that state keys are dense, stable, and follow overriding maps"""
+
+    keys = [mover.state_key(state) for state in [('S', 'A'), ('S', 'B'), ('S', 'C')]]
+    assert sorted(keys) == [0, 1, 2]
+
+    mover.add_move_probs({('S', 'A'): {'C': 1.0}, ('I', 'A'): {'B': 1.0}})
+
+    assert mover.state_key(('S', 'A')) == keys[0]
+    assert mover.state_key(('I', 'A')) == 3
+    assert mover.next_location_by_key(keys[0]) == 'C'
+    assert list(mover.next_locations_by_key(3, 2)) == ['B', 'B']
+
+def test_seed_batch_draws(mover):
+    """Tests that reseeding reproduces the same batch of draws"""
+
+    markov_mover.seed(42)
+    first = mover.next_locations(('S', 'A'), 100)
+    markov_mover.seed(42)
+    second = mover.next_locations(('S', 'A'), 100)
+
+    assert list(first) == list(second)
+
+def test_walk():
+    """Tests that a walk rolls the history forward and stops on unknown states"""
+
+    mover = MarkovMover({
+        ('S', 'A'): {'B': 1.0},
+        ('S', 'B', 'A'): {'C': 1.0},
+        ('S', 'C', 'B'): {'A': 1.0},
+        ('S', 'A', 'C'): {'B': 1.0},
+        ('S', 'B', 'C'): {'D': 1.0},
+    })
+
+    assert list(mover.walk(('S', 'A'), 4, maxhist=2)) == ['B', 'C', 'A', 'B']
+    with pytest.raises(KeyError):
+        mover.walk(('S', 'A'), 4, maxhist=1)
+
+    empty = MarkovMover()
+    with pytest.raises(KeyError):
+        empty.walk(('S', 'A'), 4, maxhist=1)
+    assert empty.stationary_distribution(maxhist=1) == {}
+
+def test_walk_zero_weight_state():
+    """Tests that every draw path stops on a state whose weights sum to zero"""
+
+    mover = MarkovMover({('S', 'B'): {'A': 1.0}, ('S', 'A'): {'B': 0.0, 'C': 0.0}})
+
+    with pytest.raises(ValueError):
+        mover.next_location(('S', 'A'))
+    with pytest.raises(ValueError):
+        mover.next_locations(('S', 'A'), 3)
+    with pytest.raises(ValueError):
+        mover.next_location_counts(('S', 'A'), 3)
+    with pytest.raises(ValueError):
+        mover.walk(('S', 'A'), 5, maxhist=1)
+    with pytest.raises(ValueError):
+        mover.walk(('S', 'B'), 5, maxhist=1)
+    assert all(np.isfinite(p) for p in mover.stationary_distribution(maxhist=1).values())
+
+def test_next_location_counts(mover):
+    """Tests that tallied draws cover every outcome and sum to n"""
+
+    counts = mover.next_location_counts(('S', 'B'), 1000)
+
+    assert set(counts) == {'A', 'C'}
+    assert sum(counts.values()) == 1000
+
+@pytest.mark.usefixtures("seeded")
+@pytest.mark.parametrize('pdict', [
+    {i: (i % 5) / 40 for i in range(20)},
+    {i: 1 / 300 for i in range(300)},
+])
+def test_weighted_choice_alias(pdict):
+    """Tests that alias-table draws, batched and single, follow the distribution"""
+
+    outcomes = CompiledOutcomes(pdict)
+    N = 200_000
+    batch = outcomes.weighted_choice_counts(N)
+    single = Counter(outcomes.weighted_choice() for _ in range(N))
+
+    for counts in (batch, single):
+        assert [counts[k] / N for k in pdict] == pytest.approx(list(pdict.values()), abs=3e-3)
+
+def test_compiled_walk_matches_python(mover):
+    """Tests that the compiled walk kernel follows the same draws as the pure-Python loop"""
+
+    _sampler = pytest.importorskip('mkmover._sampler')
+    from mkmover import _jit
+
+    cdf, totals, next_state, _ = mover._compile_chain(maxhist=1)
+    start = mover.state_key(('S', 'A'))
+    compiled = _sampler.walk_states(cdf, totals, next_state, start, 1000, np.random.default_rng(7))
+    python = _jit._walk_states(cdf, totals, next_state, start, 1000, np.random.default_rng(7))
+
+    assert list(compiled) == list(python)
+
+def test_weighted_choice_counts_zero_weight():
+    """Tests that batch draws and tallies refuse outcome maps whose weights sum to zero"""
+
+    outcomes = CompiledOutcomes({'B': 0.0, 'C': 0.0})
+
+    with pytest.raises(ValueError):
+        outcomes.weighted_choice_counts(3)
+    with pytest.raises(ValueError):
+        outcomes.weighted_choice_batch(3)